@@ -703,6 +703,10 @@ public:
 
 extern "C" {
 
+// Entry points loaded with ctypes, they must stay visible when building with
+// -fvisibility=hidden
+#pragma GCC visibility push(default)
+
 BinaryValue* mr_eval_context(ContextInfo *context_info, char *str, int len, unsigned long timeout, size_t max_memory) {
     BinaryValue *res = MiniRacer_eval_context_unsafe(context_info, str, len, timeout, max_memory);
     return res;
@@ -740,4 +744,6 @@ BinaryValue* mr_heap_snapshot(ContextInfo *context_info) {
     snap->Serialize(&bos);
     return bos.bv;
 }
+
+#pragma GCC visibility pop
 }
@@ -1,15 +1,35 @@
 # -*- coding: utf-8 -*-
 import errno
+import hashlib
+import json
 
 import logging
 import os
 import os.path
+import shutil
+import stat
 import subprocess
+import tempfile
 import multiprocessing
 
-from glob import glob
-from os.path import join, dirname, abspath
-from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from os.path import join, dirname, abspath, basename
+
+try:
+    from shutil import which
+except ImportError:
+    # Python 2
+    def which(cmd, path=None):
+        """ Return the path of the executable cmd found in path, like
+        shutil.which
+        """
+        if path is None:
+            path = os.environ.get('PATH', os.defpath)
+        for directory in path.split(os.pathsep):
+            candidate = join(directory, cmd)
+            if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+                return candidate
+        return None
 
 
 logging.basicConfig()
@@ -28,30 +48,65 @@ def local_path(path):
 
 VENDOR_PATH = local_path('../../vendor/depot_tools')
 PATCHES_PATH = local_path('../../patches')
+DEPOT_TOOLS_URL = ('https://chromium.googlesource.com/chromium/tools/'
+                   'depot_tools.git')
+BUILD_PATH = 'out.gn/x64.release'
+GN_HASH_FILE = '.pymr_gn_hash'
+APPLIED_PATCHES_FILE = '.applied_patches.json'
 
 
-def call(cmd):
-    LOGGER.debug("Calling: '%s' from working directory %s", cmd, os.getcwd())
-    current_env = os.environ
-    depot_tools_env = '{}:{}'.format(VENDOR_PATH, os.environ['PATH'])
-    current_env['PATH'] = depot_tools_env
-    return subprocess.check_call(cmd, shell=True, env=current_env)
+# Environment shared by every build command, computed once with depot_tools
+# prepended to the PATH
+BUILD_ENV = dict(os.environ)
+BUILD_ENV['PATH'] = os.pathsep.join([VENDOR_PATH, os.environ.get('PATH', '')])
+BUILD_ENV['DEPOT_TOOLS_WIN_TOOLCHAIN'] = '0'
 
 
-@contextmanager
-def chdir(new_path, make=False):
-    old_path = os.getcwd()
+# Resolved absolute paths of the build tools, see find_tool
+TOOL_PATHS = {}
 
-    if make is True:
-        try:
-            os.mkdir(new_path)
-        except OSError:
-            pass
 
-    try:
-        yield os.chdir(new_path)
-    finally:
-        os.chdir(old_path)
+def find_tool(name):
+    """ Return the absolute path of the executable name in the build PATH
+
+    Only found tools are cached: depot_tools may be cloned after import.
+    """
+    if name not in TOOL_PATHS:
+        tool_path = which(name, path=BUILD_ENV['PATH'])
+        if tool_path is None:
+            return name
+        TOOL_PATHS[name] = abspath(tool_path)
+    return TOOL_PATHS[name]
+
+
+def call(cmd, cwd=None, env=None, stdin=None):
+    """ Run cmd, a list of arguments, without going through a shell
+    """
+    LOGGER.debug("Calling: '%s' from working directory %s", ' '.join(cmd),
+                 cwd or os.getcwd())
+    if env is None:
+        env = BUILD_ENV
+    executable = None
+    if os.sep not in cmd[0]:
+        executable = find_tool(cmd[0])
+    if stdin is None:
+        with open(os.devnull, 'rb') as devnull:
+            return subprocess.check_call(cmd, executable=executable, cwd=cwd,
+                                         env=env, stdin=devnull,
+                                         close_fds=True)
+    return subprocess.check_call(cmd, executable=executable, cwd=cwd, env=env,
+                                 stdin=stdin, close_fds=True)
+
+
+def install_depot_tools():
+    """ Clone depot_tools if needed, easier than using submodules
+    """
+    if os.path.isdir(VENDOR_PATH):
+        return
+
+    LOGGER.info("cloning depot tools")
+    call(["git", "init"], cwd=local_path('../..'))
+    call(["git", "clone", DEPOT_TOOLS_URL, VENDOR_PATH])
 
 
 def ensure_v8_src():
@@ -71,31 +126,39 @@ def ensure_v8_src():
 def fetch_v8(path):
     """ Fetch v8
     """
-    with chdir(abspath(path), make=True):
-        call("fetch v8")
+    path = abspath(path)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    call(["fetch", "v8"], cwd=path)
 
 
 def update_v8(path):
     """ Update v8 repository
     """
-    with chdir(path):
-        call("gclient fetch")
+    call(["gclient", "fetch"], cwd=path)
 
 
 def checkout_v8_version(path, version):
     """ Ensure that we have the right version
     """
-    with chdir(path):
-        call("git checkout {} -- .".format(version))
+    call(["git", "checkout", version, "--", "."], cwd=path)
 
 
 def dependencies_sync(path):
     """ Sync v8 build dependencies
-    """
-    with chdir(path):
-        call("gclient sync")
 
-def gen_makefiles(path):
+    Dependencies are fetched without their history unless PYMR_FULL_HISTORY
+    is set.
+    """
+    cmd = ["gclient", "sync"]
+    if not os.environ.get('PYMR_FULL_HISTORY'):
+        cmd += ["--no-history", "--shallow",
+                "--jobs", str(multiprocessing.cpu_count())]
+    call(cmd, cwd=path)
+
+def gen_makefiles(path, use_goma=False):
+    """ Generate the ninja build files, unless they already match the gn args
+    """
     opts = {
         'is_component_build': 'false',
         'v8_monolithic': 'true',
@@ -110,17 +173,47 @@ def gen_makefiles(path):
         'v8_experimental_extra_library_files': '[]',
         'v8_extra_library_files': '[]'
     }
-    joined_opts = ' '.join('{}={}'.format(a, b) for (a, b) in opts.items())
-
-    with chdir(path):
-        call('./tools/dev/v8gen.py -vv x64.release -- ' + joined_opts)
-
-def make(path, cmd_prefix):
+    if use_goma:
+        opts['use_goma'] = 'true'
+    gn_args = ['{}={}'.format(a, b) for (a, b) in sorted(opts.items())]
+    gn_hash = hashlib.sha256(repr(gn_args).encode('utf8')).hexdigest()
+
+    build_path = join(path, BUILD_PATH)
+    hash_path = join(build_path, GN_HASH_FILE)
+    if os.path.isfile(join(build_path, 'build.ninja')) and \
+            os.path.isfile(hash_path):
+        with open(hash_path) as hash_file:
+            if hash_file.read().strip() == gn_hash:
+                LOGGER.debug("gn args unchanged, skipping gn gen")
+                return
+
+    call(['./tools/dev/v8gen.py', '-vv', 'x64.release', '--'] + gn_args,
+         cwd=path)
+
+    with open(hash_path, 'w') as hash_file:
+        hash_file.write(gn_hash)
+
+def make(path, env_overrides=None, use_goma=False):
     """ Create a release of v8
+
+    ninja picks the number of parallel jobs from the CPU count unless
+    PYMR_NINJA_JOBS is set, goma builds default to 200 jobs. Set
+    PYMR_NINJA_VERBOSE to print the full compiler command lines.
     """
-    with chdir(path):
-        call("{} ninja -vv -C out.gn/x64.release -j {} v8_monolith"
-             .format(cmd_prefix, 4))
+    env = BUILD_ENV
+    if env_overrides:
+        env = dict(BUILD_ENV)
+        env.update(env_overrides)
+
+    cmd = ["ninja", "-C", BUILD_PATH]
+    if os.environ.get('PYMR_NINJA_JOBS'):
+        cmd += ["-j", os.environ['PYMR_NINJA_JOBS']]
+    elif use_goma:
+        cmd += ["-j", "200"]
+    if os.environ.get('PYMR_NINJA_VERBOSE'):
+        cmd += ["-v"]
+
+    call(cmd + ["v8_monolith"], cwd=path, env=env)
 
 def patch_v8():
     """ Apply patch on v8
@@ -131,6 +224,11 @@ def patch_v8():
 
 
 def symlink_force(target, link_name):
+    """ Make link_name a symlink to target, replacing any existing file
+    """
+    if os.path.islink(link_name) and os.readlink(link_name) == target:
+        return
+
     try:
         os.symlink(target, link_name)
     except OSError as e:
@@ -142,46 +240,177 @@ def symlink_force(target, link_name):
 
 
 def fixup_libtinfo(dir):
+    """ Make a libtinfo.so.5 available to the v8 toolchain, linking it to
+    libtinfo.so.6 when only the latter is installed
+
+    Return the environment variables the toolchain needs to find it.
+    """
     dirs = ['/lib64', '/usr/lib64', '/lib', '/usr/lib']
+    names = ('libtinfo.so.5', 'libtinfo.so.6')
 
-    v5_locs = ["{}/libtinfo.so.5".format(d) for d in dirs]
-    found_v5 = next((f for f in v5_locs if os.path.isfile(f)), None)
-    if found_v5 and os.stat(found_v5).st_size > 100:
-        return ''
+    # One listing per directory, keeping the first regular file found for
+    # each version with its size
+    found = {}
+    for d in dirs:
+        try:
+            entries = set(os.listdir(d))
+        except OSError:
+            continue
+        for name in names:
+            if name in entries and name not in found:
+                path = join(d, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if stat.S_ISREG(st.st_mode):
+                    found[name] = (path, st.st_size)
+
+    if 'libtinfo.so.5' in found and found['libtinfo.so.5'][1] > 100:
+        return {}
 
-    v6_locs = ["{}/libtinfo.so.6".format(d) for d in dirs]
-    found_v6 = next((f for f in v6_locs if os.path.isfile(f)), None)
-    if not found_v6:
-        return ''
+    if 'libtinfo.so.6' not in found:
+        return {}
 
-    symlink_force(found_v6, join(dir, 'libtinfo.so.5'))
-    return "LD_LIBRARY_PATH='{}:{}'"\
-        .format(dir, os.getenv('LD_LIBRARY_PATH', ''))
+    symlink_force(found['libtinfo.so.6'][0], join(dir, 'libtinfo.so.5'))
+    return {'LD_LIBRARY_PATH': os.pathsep.join(
+        [dir, os.environ.get('LD_LIBRARY_PATH', '')])}
 
 
 def apply_patches(path, patches_path):
-    with chdir(path):
+    """ Apply every patch not applied yet with a single command
 
-        if not os.path.isfile('.applied_patches'):
-            open('.applied_patches', 'w').close()
+    Applied patches are tracked by content digest, so renaming a patch does
+    not apply it again.
+    """
+    digests = patch_digests(patches_path)
+    names = sorted(digests)
 
-        with open('.applied_patches', 'r+') as applied_patches_file:
-            applied_patches = set(applied_patches_file.read().splitlines())
+    applied_patches = read_applied_patches(path)
+    applied_digests = set(applied_patches.values())
 
-            for patch in glob(join(patches_path, '*.patch')):
-                if patch not in applied_patches:
-                    call("patch -p1 -N < {}".format(patch))
+    pending = [name for name in names
+               if digests[name] not in applied_digests]
+    if not pending:
+        return
 
-                    applied_patches_file.write(patch + "\n")
+    pending_paths = [join(patches_path, name) for name in pending]
+    prefetch(pending_paths)
+
+    if os.path.isabs(find_tool('git')):
+        # git apply checks every patch before touching the tree, so a
+        # failure leaves nothing half applied
+        call(["git", "apply", "--whitespace=nowarn", "-p1"] + pending_paths,
+             cwd=path)
+    else:
+        with tempfile.TemporaryFile() as patches_file:
+            for patch in pending_paths:
+                with open(patch, 'rb') as patch_file:
+                    shutil.copyfileobj(patch_file, patches_file)
+            patches_file.seek(0)
+            call(["patch", "-p1", "-N"], cwd=path, stdin=patches_file)
+
+    applied_patches.update((name, digests[name]) for name in pending)
+    write_json(join(path, APPLIED_PATCHES_FILE), applied_patches)
+
+
+def prefetch(paths):
+    """ Hint the kernel to read paths ahead, before a subprocess reads them
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            # Advices are not flags, they have to be given one at a time
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
 
 
-def build_v8():
+def patch_digest(path):
+    """ Return the sha1 of the content of a patch file
+    """
+    with open(path, 'rb') as patch_file:
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(patch_file, 'sha1').hexdigest()
+        digest = hashlib.sha1()
+        for chunk in iter(lambda: patch_file.read(65536), b''):
+            digest.update(chunk)
+        return digest.hexdigest()
+
+
+def patch_digests(patches_path):
+    """ Return the {name: digest} of the patches, hashed in parallel
+
+    hashlib releases the GIL while hashing, threads are enough.
+    """
+    if not os.path.isdir(patches_path):
+        return {}
+    names = [name for name in os.listdir(patches_path)
+             if name.endswith('.patch')]
+    if not names:
+        return {}
+    pool = ThreadPool(min(len(names), multiprocessing.cpu_count()))
+    try:
+        digests = pool.map(patch_digest,
+                           [join(patches_path, name) for name in names])
+    finally:
+        pool.close()
+        pool.join()
+    return dict(zip(names, digests))
+
+
+def read_applied_patches(path):
+    """ Return the {name: digest} of the patches applied to the checkout
+    """
+    applied_patches_path = join(path, APPLIED_PATCHES_FILE)
+    if os.path.isfile(applied_patches_path):
+        with open(applied_patches_path) as applied_patches_file:
+            return json.load(applied_patches_file)
+
+    # Checkouts patched before digests were tracked list the patch paths
+    applied_patches = {}
+    legacy_path = join(path, '.applied_patches')
+    if os.path.isfile(legacy_path):
+        with open(legacy_path) as applied_patches_file:
+            for patch in applied_patches_file.read().splitlines():
+                if os.path.isfile(patch):
+                    applied_patches[basename(patch)] = patch_digest(patch)
+    return applied_patches
+
+
+def write_json(path, data):
+    """ Atomically replace the content of path with data serialized as JSON
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=dirname(abspath(path)))
+    with os.fdopen(fd, 'w') as tmp_file:
+        json.dump(data, tmp_file, indent=2, sort_keys=True)
+    os.rename(tmp_path, path)
+
+
+def build_v8(use_goma=False):
+    install_depot_tools()
     ensure_v8_src()
     patch_v8()
     checkout_path = local_path('v8/v8')
-    cmd_prefix = fixup_libtinfo(checkout_path)
-    gen_makefiles(checkout_path)
-    make(checkout_path, cmd_prefix)
+    env_overrides = fixup_libtinfo(checkout_path)
+    gen_makefiles(checkout_path, use_goma)
+    make(checkout_path, env_overrides, use_goma)
+
+
+def configure_v8(use_goma=False):
+    """ Generate the build files of an already fetched v8
+    """
+    gen_makefiles(local_path('v8/v8'), use_goma)
+
+
+def compile_v8(use_goma=False):
+    """ Compile an already configured v8
+    """
+    checkout_path = local_path('v8/v8')
+    make(checkout_path, fixup_libtinfo(checkout_path), use_goma)
 
 
 if __name__ == '__main__':
@@ -2,17 +2,24 @@
 # -*- coding: utf-8 -*-
 
 import os
-import pip
 import sys
-import codecs
-import pkg_resources
+import io
+import shutil
 import traceback
 
 from itertools import chain
-from subprocess import check_call, check_output, STDOUT
-from os.path import dirname, abspath, join, isfile, isdir, basename
+from subprocess import check_output, STDOUT
+from os.path import dirname, abspath, join, isfile, isdir, basename, samefile
 
-from distutils.file_util import copy_file
+try:
+    from functools import lru_cache
+except ImportError:
+    # Python 2: no caching
+    def lru_cache(maxsize=128):
+        def decorator(func):
+            func.cache_clear = lambda: None
+            return func
+        return decorator
 
 try:
     from setuptools import setup, Extension, Command
@@ -24,36 +31,37 @@ except ImportError:
     from distutils.command.install import install
 
 import py_mini_racer
-from py_mini_racer.extension.v8_build import build_v8
+from py_mini_racer.extension.v8_build import build_v8, configure_v8, compile_v8, which
 
 V8_PATH = os.environ.get("PY_MINI_RACER_V8_PATH")
+DEBUG = bool(os.environ.get("PYMR_DEBUG"))
 
-with codecs.open('README.rst', 'r', encoding='utf8') as readme_file:
-    readme = readme_file.read()
-
-    # Convert local image links by their github equivalent
-    readme = readme.replace(".. image:: data/",
-                            ".. image:: https://github.com/sqreen/PyMiniRacer/raw/master/data/")
+with io.open('README.rst', 'r', encoding='utf8') as readme_file:
+    # Convert the local image link by its github equivalent
+    readme = readme_file.read().replace(
+        ".. image:: data/",
+        ".. image:: https://github.com/sqreen/PyMiniRacer/raw/master/data/", 1)
 
-with codecs.open('HISTORY.rst', 'r', encoding='utf8') as history_file:
-    history = history_file.read().replace('.. :changelog:', '')
+with io.open('HISTORY.rst', 'r', encoding='utf8') as history_file:
+    history = history_file.read().replace('.. :changelog:', '', 1)
 
 
 def _parse_requirements(filepath):
-    pip_version = list(map(int, pkg_resources.get_distribution('pip').version.split('.')[:2]))
-    if pip_version >= [10, 0]:
-        from pip._internal.download import PipSession
-        from pip._internal.req import parse_requirements
-        raw = parse_requirements(filepath, session=PipSession())
-    elif pip_version >= [6, 0]:
-        from pip.download import PipSession
-        from pip.req import parse_requirements
-        raw = parse_requirements(filepath, session=PipSession())
-    else:
-        from pip.req import parse_requirements
-        raw = parse_requirements(filepath)
-
-    return [str(i.req) for i in raw]
+    """ Return the requirement strings of a pip requirements file, following
+    '-r' includes
+    """
+    requirements = []
+    with io.open(filepath, 'r', encoding='utf8') as requirements_file:
+        for line in requirements_file:
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            if line.startswith('-r'):
+                included = line[2:].strip()
+                requirements += _parse_requirements(join(dirname(filepath), included))
+            elif not line.startswith('-'):
+                requirements.append(line)
+    return requirements
 
 
 requirements = _parse_requirements('requirements/prod.txt')
@@ -84,16 +92,15 @@ def is_v8_built():
 def check_python_version():
     """ Check that the python executable is Python 2.7.
     """
+    python_path = which('python')
+    if python_path and samefile(python_path, sys.executable):
+        return sys.version_info[:2] == (2, 7)
+
     output = check_output(['python', '--version'], stderr=STDOUT)
     return output.strip().decode().startswith('Python 2.7')
 
 
-def is_depot_tools_checkout():
-    """ Check if the depot tools submodule has been checkouted
-    """
-    return isdir(local_path('vendor/depot_tools'))
-
-
+@lru_cache(maxsize=None)
 def libv8_object(object_name):
     """ Return a path for object_name which is OS independent
     """
@@ -109,6 +116,7 @@ def libv8_object(object_name):
     return filename
 
 
+@lru_cache(maxsize=1)
 def get_include_path():
     """ Return the V8 header files
     """
@@ -116,6 +124,7 @@ def get_include_path():
     return [join(V8_LIB_DIRECTORY, "include", header) for header in headers]
 
 
+@lru_cache(maxsize=1)
 def get_raw_static_lib_path():
     """ Return the list of the static libraries files ONLY, use
     get_static_lib_paths to get the right compilation flags
@@ -123,6 +132,7 @@ def get_raw_static_lib_path():
     return [libv8_object(static_file) for static_file in V8_STATIC_LIBRARIES]
 
 
+@lru_cache(maxsize=1)
 def get_static_lib_paths():
     """ Return the required static libraries path
     """
@@ -135,6 +145,13 @@ def get_static_lib_paths():
         libs += ['-Wl,--end-group']
     return libs
 
+
+def clear_lib_path_caches():
+    """ Forget the static library paths resolved before v8 was built
+    """
+    for func in (libv8_object, get_raw_static_lib_path, get_static_lib_paths):
+        func.cache_clear()
+
 EXTRA_LINK_ARGS = [
     '-ldl',
     '-fstack-protector',
@@ -155,13 +172,24 @@ elif sys.platform.startswith('linux'):
     EXTRA_COMPILE_ARGS += ['-rdynamic']
     EXTRA_LINK_ARGS    += ['-lrt']
 
+# Optimized release builds (the optimization level comes from the Python
+# CFLAGS), the ctypes entry points are explicitly exported
+if not DEBUG:
+    EXTRA_COMPILE_ARGS += ['-flto', '-fvisibility=hidden']
+    EXTRA_LINK_ARGS    += ['-flto']
+    if sys.platform.startswith('linux'):
+        EXTRA_COMPILE_ARGS += ['-fno-plt', '-ffunction-sections', '-fdata-sections']
+        # --as-needed only applies to the libraries following it
+        EXTRA_LINK_ARGS = ['-Wl,-O1,--as-needed,--gc-sections'] + EXTRA_LINK_ARGS
+
 
 PY_MINI_RACER_EXTENSION = Extension(
     name="py_mini_racer._v8",
     language='c++',
     sources=['py_mini_racer/extension/mini_racer_extension.cc'],
     include_dirs=[V8_LIB_DIRECTORY, join(V8_LIB_DIRECTORY, 'include'), local_path('vendor/v8/include')],
-    extra_objects=get_static_lib_paths(),
+    # Filled by MiniRacerBuildExt, prebuilt extensions don't need them
+    extra_objects=[],
     extra_compile_args=EXTRA_COMPILE_ARGS,
     extra_link_args=EXTRA_LINK_ARGS
 )
@@ -182,11 +210,19 @@ class MiniRacerBuildExt(build_ext):
             if not is_v8_built():
                 self.run_command('build_v8')
 
-            self.debug = True
+            self.debug = DEBUG
             if V8_PATH:
-                dest_filename = join(self.build_lib, "py_mini_racer")
-                copy_file(V8_PATH, dest_filename, verbose=self.verbose, dry_run=self.dry_run)
+                dest_dir = join(self.build_lib, "py_mini_racer")
+                dest_filename = join(dest_dir, basename(V8_PATH))
+                self.announce("copying %s -> %s" % (V8_PATH, dest_dir))
+                if not self.dry_run:
+                    if not isdir(dest_dir):
+                        os.makedirs(dest_dir)
+                    # shutil uses the zero-copy sendfile path when available
+                    shutil.copyfile(V8_PATH, dest_filename)
+                    shutil.copymode(V8_PATH, dest_filename)
             else:
+                ext.extra_objects = get_static_lib_paths()
                 build_ext.build_extension(self, ext)
 
         except Exception as e:
@@ -206,43 +242,67 @@ class MiniRacerBuildV8(Command):
 
     description = 'Compile vendored v8'
     user_options = [
+        ('use-goma', None, 'build v8 with the goma distributed compiler'),
     ]
+    boolean_options = ['use-goma']
 
     def initialize_options(self):
         """Set default values for options."""
+        self.use_goma = False
 
     def finalize_options(self):
         """Post-process options."""
         pass
 
-    def run(self):
-        if V8_PATH:
-            return
-
+    def check_python_version(self):
         if not check_python_version():
             msg = """py_mini_racer cannot build V8 in the current configuration.
             The V8 build system requires the python executable to be Python 2.7.
             See also: https://github.com/sqreen/PyMiniRacer#build"""
             raise Exception(msg)
 
-        if not is_v8_built():
+    def run(self):
+        if V8_PATH:
+            return
 
-            if not is_depot_tools_checkout():
-                print("cloning depot tools submodule")
-                # Clone the depot_tools repository, easier than using submodules
-                check_call(['git', 'init'])
-                check_call(['git', 'clone', 'https://chromium.googlesource.com/chromium/tools/depot_tools.git', 'vendor/depot_tools'])
+        self.check_python_version()
 
+        if not is_v8_built():
             print("building v8")
-            build_v8()
+            build_v8(use_goma=self.use_goma)
+            clear_lib_path_caches()
         else:
             print("v8 is already built")
 
+
+class MiniRacerConfigureV8(MiniRacerBuildV8):
+
+    description = 'Generate the build files of the vendored v8 (gn gen)'
+
+    def run(self):
+        if V8_PATH:
+            return
+
+        self.check_python_version()
+        configure_v8(use_goma=self.use_goma)
+
+
+class MiniRacerCompileV8(MiniRacerBuildV8):
+
+    description = 'Compile the configured vendored v8 (ninja)'
+
+    def run(self):
+        if V8_PATH:
+            return
+
+        compile_v8(use_goma=self.use_goma)
+        clear_lib_path_caches()
+
 setup(
     name='py_mini_racer',
     version=py_mini_racer.__version__,
     description="Minimal, modern embedded V8 for Python.",
-    long_description=readme + '\n\n' + history,
+    long_description=''.join((readme, '\n\n', history)),
     long_description_content_type='text/markdown',
     author='Sqreen',
     author_email='hey@sqreen.io',
@@ -278,5 +338,7 @@ setup(
     cmdclass={
         'build_ext': MiniRacerBuildExt,
         'build_v8': MiniRacerBuildV8,
+        'build_v8_configure': MiniRacerConfigureV8,
+        'build_v8_compile': MiniRacerCompileV8,
     }
 )